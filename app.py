@@ -1,135 +1,381 @@
+import hashlib
 import re
+import zipfile
+from calendar import monthrange
 import streamlit as st
 import pandas as pd
-from datetime import date, datetime
-from io import BytesIO
-from typing import List, Optional, Tuple, Dict
+from datetime import date
+from io import BytesIO, TextIOWrapper
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from math import isfinite
+from xml.sax.saxutils import escape as xml_escape, quoteattr as xml_quoteattr
 
 st.set_page_config(page_title="GPIRS Shortage Report Converter", layout="wide")
 st.title("📄 GPIRS Shortage Report Converter (.TXT to .XLSX)")
 
-# ------------------------------- Utilities ---------------------------------- #
+# ------------------------------- Patterns ----------------------------------- #
+
+_DATE_PAT = r"([0-9]{4}[/-][0-9]{2}[/-][0-9]{2}|[0-9]{2}/[0-9]{2}/[0-9]{4})"
+_SHIP_DOC_RE = re.compile(r"Shipping\s+Document\s+No:\s*([A-Za-z0-9\-_/]+)", re.IGNORECASE)
+_RECEIVED_RE = re.compile(r"Received\s+Date:\s*" + _DATE_PAT, re.IGNORECASE)
+_CREATED_RE = re.compile(r"Date\s+Created:\s*" + _DATE_PAT, re.IGNORECASE)
+_SANITIZE_RE = re.compile(r"[^A-Za-z0-9\-_]")
+_ISO_DATE_RE = re.compile(r"(\d{4})([/-])(\d{1,2})\2(\d{1,2})")
+_DMY_DATE_RE = re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4})")
+
+# Header fields (doc number, dates) are searched for in this many leading chars first
+_HEADER_SCAN_CHARS = 2048
+
+_UTF8_BOM = b"\xef\xbb\xbf"
+
+# Output column order: Ticket Number second-from-last, Additional Info last.
+# parse_lines returns its column dict in this same key order.
+FIXED_COLS = [
+    "Line", "Date Rcvd", "Part Prefix", "Part Base", "Part Suffix", "Description",
+    "Quantity", "UOM", "Unit Price ($)", "Total Price", "TAMS", "Source Doc",
+    "Ticket Number", "Additional Info",
+]
+NUMERIC_COLS = ["Quantity", "Unit Price ($)", "Total Price"]
+
+# Max rows rendered in the on-page table (large enough for normal copy/paste use)
+PREVIEW_ROWS = 5000
 
-def tokenize(line: str) -> List[str]:
-    line = line.replace("\x0c", " ").strip()
-    return [t for t in line.split() if t]
+# ------------------------------- Utilities ---------------------------------- #
 
-def extract_shipping_doc_number(txt: str) -> Optional[str]:
-    m = re.search(r"Shipping\s+Document\s+No:\s*([A-Za-z0-9\-_/]+)", txt, re.IGNORECASE)
+def _ship_doc_from(m: Optional[re.Match]) -> Optional[str]:
     if not m:
         return None
-    return re.sub(r"[^A-Za-z0-9\-_]", "_", m.group(1).strip()) or None
+    return _SANITIZE_RE.sub("_", m.group(1).strip()) or None
+
+def _valid_ymd(y: int, m: int, d: int) -> bool:
+    return y >= 1 and 1 <= m <= 12 and 1 <= d <= monthrange(y, m)[1]
 
 def normalize_date_str(s: str) -> Optional[str]:
+    """
+    YYYY/MM/DD or YYYY-MM-DD, else DD/MM/YYYY (preferred) or MM/DD/YYYY.
+    Returns ISO 'YYYY-MM-DD' or None.
+    """
     s = s.strip()
-    for fmt in ("%Y/%m/%d", "%Y-%m-%d", "%d/%m/%Y", "%m/%d/%Y"):
-        try:
-            return datetime.strptime(s, fmt).strftime("%Y-%m-%d")
-        except ValueError:
-            pass
+    m = _ISO_DATE_RE.fullmatch(s)
+    if m:
+        y, mo, d = int(m.group(1)), int(m.group(3)), int(m.group(4))
+        return f"{y:04d}-{mo:02d}-{d:02d}" if _valid_ymd(y, mo, d) else None
+    m = _DMY_DATE_RE.fullmatch(s)
+    if m:
+        a, b, y = int(m.group(1)), int(m.group(2)), int(m.group(3))
+        if _valid_ymd(y, b, a):
+            return f"{y:04d}-{b:02d}-{a:02d}"
+        if _valid_ymd(y, a, b):
+            return f"{y:04d}-{a:02d}-{b:02d}"
     return None
 
-def extract_received_or_created_date(txt: str) -> str:
-    rec = re.search(r"Received\s+Date:\s*([0-9]{4}[/-][0-9]{2}[/-][0-9]{2}|[0-9]{2}/[0-9]{2}/[0-9]{4})",
-                    txt, re.IGNORECASE)
-    if rec:
-        d = normalize_date_str(rec.group(1))
-        if d:
-            return d
-    created = re.search(r"Date\s+Created:\s*([0-9]{4}[/-][0-9]{2}[/-][0-9]{2}|[0-9]{2}/[0-9]{2}/[0-9]{4})",
-                        txt, re.IGNORECASE)
-    if created:
-        d = normalize_date_str(created.group(1))
-        if d:
-            return d
-    return date.today().strftime("%Y-%m-%d")
+def _header_date_from(rec: Optional[re.Match], created: Optional[re.Match]) -> Optional[str]:
+    """Received Date wins over Date Created; None if neither normalizes."""
+    for m in (rec, created):
+        if m:
+            d = normalize_date_str(m.group(1))
+            if d:
+                return d
+    return None
+
+def scan_header(lines: Iterable[str], header: Dict) -> Iterator[str]:
+    """
+    Pass `lines` through unchanged, keeping the head (~_HEADER_SCAN_CHARS,
+    whole lines) in header["head"]. header["complete"] is True when the
+    stream ended inside the head, i.e. the head is the whole text.
+    """
+    it = iter(lines)
+    head_parts: List[str] = []
+    head_len = 0
+    header["complete"] = True
+    for line in it:
+        head_parts.append(line)
+        head_len += len(line)
+        yield line
+        if head_len > _HEADER_SCAN_CHARS:
+            header["complete"] = False
+            break
+    header["head"] = "".join(head_parts)
+    yield from it
+
+def find_header_fields(header: Dict, full_text: Optional[Callable[[], str]],
+                       want_date: bool = True) -> Tuple[Optional[re.Match], ...]:
+    """
+    (doc, received, created) matches. The head is searched first; fields still
+    missing are searched for in the full text as one block, which is only
+    fetched (via `full_text`) when actually needed.
+    """
+    head = header.get("head", "")
+    can_fall_back = not header.get("complete", True) and full_text is not None
+    text: Optional[str] = None
+
+    def search(pat: re.Pattern) -> Optional[re.Match]:
+        nonlocal text
+        m = pat.search(head)
+        if m is None and can_fall_back:
+            if text is None:
+                text = full_text()
+            m = pat.search(text)
+        return m
+
+    doc = search(_SHIP_DOC_RE)
+    rec = created = None
+    if want_date:
+        # Each field falls back on its own: a Received Date anywhere beats a
+        # Date Created in the head; Created is only looked up if Received fails
+        rec = search(_RECEIVED_RE)
+        if _header_date_from(rec, None) is None:
+            created = search(_CREATED_RE)
+    return doc, rec, created
+
+def iter_token_lines(lines: Iterable[str]) -> Iterator[List[str]]:
+    """Whitespace tokens of each non-blank line (form feeds etc. split lines, as str.splitlines does)."""
+    for line in lines:
+        for seg in line.splitlines():
+            toks = seg.split()
+            if toks:
+                yield toks
 
 def find_marker_idx(parts2: List[str]) -> Optional[int]:
     """
     Return index of the first marker token ('I' or 'S') that is followed by 'V'.
     Scans left-to-right so whichever marker appears first is used.
     """
-    for idx, tok in enumerate(parts2):
-        if tok in ("I", "S") and idx + 1 < len(parts2) and parts2[idx + 1] == "V":
+    for idx in range(len(parts2) - 1):
+        t = parts2[idx]
+        if (t == "I" or t == "S") and parts2[idx + 1] == "V":
             return idx
     return None
 
 # ------------------------------- Parsing ------------------------------------ #
 
-def parse_one_text(txt_content: str, override_date: Optional[str]) -> Tuple[pd.DataFrame, Dict]:
-    raw_lines = txt_content.splitlines()
-    cleaned_lines = [ln.strip().replace("\x0c", "") for ln in raw_lines if ln.strip()]
-
-    doc_no = extract_shipping_doc_number(txt_content)
-    date_rcvd = override_date or extract_received_or_created_date(txt_content)
-
-    entries = []
-    i = 0
-    while i < len(cleaned_lines) - 1:
-        line1 = cleaned_lines[i]
-        first_tokens = tokenize(line1)
-
-        if first_tokens and first_tokens[0].isdigit():
-            if i + 1 < len(cleaned_lines):
-                line2 = cleaned_lines[i + 1]
-                parts1 = first_tokens
-                parts2 = tokenize(line2)
-
-                if len(parts1) >= 8 and len(parts2) >= 5 and parts2[0].isdigit():
-                    marker_idx = find_marker_idx(parts2)
-                    if marker_idx is not None:
-                        # Description is everything after the ticket up to marker ('I' or 'S')
-                        description = " ".join(parts2[1:marker_idx])
-
-                        # TAMS is token after 'V'
-                        tams_idx = marker_idx + 2
-                        tams = parts2[tams_idx] if tams_idx < len(parts2) else ""
-
-                        # Additional Info: all non-dot tokens after TAMS
-                        tail = [t for t in parts2[tams_idx + 1:] if t != "."]
-                        additional_info = " ".join(tail)
-
-                        entry = {
-                            "Line": parts1[0],
-                            "Date Rcvd": date_rcvd,
-                            "Part Prefix": parts1[1],
-                            "Part Base": parts1[2],
-                            "Part Suffix": parts1[3],
-                            "Description": description,          # ✅ no trailing ' S'
-                            "Quantity": parts1[-4],
-                            "UOM": parts1[-3],
-                            "Unit Price ($)": parts1[-2],
-                            "Total Price": parts1[-1],
-                            "TAMS": tams,
-                            "Ticket Number": f"z{parts2[0]}" if parts2[0].isdigit() and len(parts2[0]) == 6 else parts2[0],
-                            "Additional Info": additional_info, # last
-                            "Source Doc": doc_no or "",
-                        }
-                        entries.append(entry)
-                        i += 2
-                        continue
-            i += 1
-        else:
-            i += 1
+def parse_lines(lines: Iterable[str], override_date: Optional[str],
+                full_text: Optional[Callable[[], str]] = None) -> Tuple[Dict[str, List[str]], Dict]:
+    """
+    Single forward pass over `lines` (any iterable of text lines, e.g. a text
+    stream), holding only the previous tokenised line as the pair window.
+    `full_text` returns the whole document for header fields missing from the head.
+    """
+    header: Dict = {}
+    token_lines = iter_token_lines(scan_header(lines, header))
+
+    # Column-wise (struct-of-arrays) accumulation; one list per output column
+    col_line: List[str] = []
+    col_prefix: List[str] = []
+    col_base: List[str] = []
+    col_suffix: List[str] = []
+    col_desc: List[str] = []
+    col_qty: List[str] = []
+    col_uom: List[str] = []
+    col_unit_price: List[str] = []
+    col_total_price: List[str] = []
+    col_tams: List[str] = []
+    col_ticket: List[str] = []
+    col_additional: List[str] = []
+
+    prev: Optional[List[str]] = None
+    for parts2 in token_lines:
+        parts1 = prev
+        if parts1 is not None and parts1[0].isdigit():
+            if len(parts1) >= 8 and len(parts2) >= 5 and parts2[0].isdigit():
+                marker_idx = find_marker_idx(parts2)
+                if marker_idx is not None:
+                    # Description is everything after the ticket up to marker ('I' or 'S')
+                    description = " ".join(parts2[1:marker_idx])
+
+                    # TAMS is token after 'V'
+                    tams_idx = marker_idx + 2
+                    tams = parts2[tams_idx] if tams_idx < len(parts2) else ""
+
+                    # Additional Info: all non-dot tokens after TAMS
+                    tail = [t for t in parts2[tams_idx + 1:] if t != "."]
+                    additional_info = " ".join(tail)
+
+                    line_no, prefix, base, suffix = parts1[:4]
+                    quantity, uom, unit_price, total_price = parts1[-4:]
+                    # Ticket is already known to be all digits (checked above)
+                    ticket = parts2[0]
+
+                    col_line.append(line_no)
+                    col_prefix.append(prefix)
+                    col_base.append(base)
+                    col_suffix.append(suffix)
+                    col_desc.append(description)          # ✅ no trailing ' S'
+                    col_qty.append(quantity)
+                    col_uom.append(uom)
+                    col_unit_price.append(unit_price)
+                    col_total_price.append(total_price)
+                    col_tams.append(tams)
+                    col_ticket.append(f"z{ticket}" if len(ticket) == 6 else ticket)
+                    col_additional.append(additional_info)
+                    # Both lines consumed; the next pair starts fresh
+                    prev = None
+                    continue
+        prev = parts2
+
+    # The head is known once the stream is exhausted
+    doc_m, rec_m, created_m = find_header_fields(header, full_text, want_date=not override_date)
+    doc_no = _ship_doc_from(doc_m)
+    # None when the report has no usable date; the caller falls back to today
+    # (kept out of here so a cached parse never pins an old "today")
+    date_rcvd = override_date or _header_date_from(rec_m, created_m)
+
+    n_rows = len(col_line)
+    columns = {
+        "Line": col_line,
+        "Date Rcvd": [date_rcvd] * n_rows,
+        "Part Prefix": col_prefix,
+        "Part Base": col_base,
+        "Part Suffix": col_suffix,
+        "Description": col_desc,
+        "Quantity": col_qty,
+        "UOM": col_uom,
+        "Unit Price ($)": col_unit_price,
+        "Total Price": col_total_price,
+        "TAMS": col_tams,
+        "Source Doc": [doc_no or ""] * n_rows,
+        "Ticket Number": col_ticket,
+        "Additional Info": col_additional, # last
+    }
 
-    df = pd.DataFrame(entries)
+    meta = {"doc_no": doc_no, "date_rcvd": date_rcvd}
+    return columns, meta
 
-    if not df.empty:
-        # Coerce numerics
-        df["Quantity"] = pd.to_numeric(df["Quantity"], errors="coerce")
-        df["Unit Price ($)"] = pd.to_numeric(df["Unit Price ($)"], errors="coerce")
-        df["Total Price"] = pd.to_numeric(df["Total Price"], errors="coerce")
+def _bom_len(raw: bytes) -> int:
+    return len(_UTF8_BOM) if raw.startswith(_UTF8_BOM) else 0
 
-        # Ensure order: Ticket Number second-from-last, Additional Info last
-        cols = list(df.columns)
-        cols.remove("Additional Info")
-        cols.remove("Ticket Number")
-        cols.append("Ticket Number")
-        cols.append("Additional Info")
-        df = df[cols]
+def open_text(raw: bytes, encoding: str) -> TextIOWrapper:
+    """Lazy text stream over the upload bytes (BOM skipped); nothing is decoded up front."""
+    buf = BytesIO(raw)
+    buf.seek(_bom_len(raw))
+    return TextIOWrapper(buf, encoding=encoding, newline="")
 
-    meta = {"doc_no": doc_no, "date_rcvd": date_rcvd}
-    return df, meta
+def decode_text(raw: bytes, encoding: str) -> str:
+    """Whole upload as one string (BOM skipped); only used for the header fallback."""
+    return raw[_bom_len(raw):].decode(encoding)
+
+# Shared by every session: keep it small and short-lived so uploads don't linger
+@st.cache_data(show_spinner=False, max_entries=64, ttl=3600)
+def parse_bytes(raw: bytes, override: Optional[str]) -> Tuple[Dict[str, List[str]], Dict]:
+    """
+    Decode + parse one uploaded file. Cached on the file bytes and override date
+    so widget reruns don't re-parse unchanged uploads.
+    """
+    try:
+        return parse_lines(open_text(raw, "utf-8"), override_date=override,
+                           full_text=lambda: decode_text(raw, "utf-8"))
+    except UnicodeDecodeError:
+        # Not UTF-8 after all; latin-1 accepts any byte string, so re-parse with it
+        return parse_lines(open_text(raw, "latin-1"), override_date=override,
+                           full_text=lambda: decode_text(raw, "latin-1"))
+
+# ------------------------------- Export ------------------------------------- #
+
+# Minimal static OOXML parts for a single unstyled sheet (no sharedStrings)
+_XML_DECL = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+_NS_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_NS_PKG_REL = "http://schemas.openxmlformats.org/package/2006/relationships"
+_CT = "application/vnd.openxmlformats-officedocument.spreadsheetml"
+
+_XLSX_CONTENT_TYPES = (
+    _XML_DECL
+    + '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    f'<Override PartName="/xl/workbook.xml" ContentType="{_CT}.sheet.main+xml"/>'
+    f'<Override PartName="/xl/worksheets/sheet1.xml" ContentType="{_CT}.worksheet+xml"/>'
+    f'<Override PartName="/xl/styles.xml" ContentType="{_CT}.styles+xml"/>'
+    "</Types>"
+)
+_XLSX_ROOT_RELS = (
+    _XML_DECL
+    + f'<Relationships xmlns="{_NS_PKG_REL}">'
+    f'<Relationship Id="rId1" Type="{_NS_REL}/officeDocument" Target="xl/workbook.xml"/>'
+    "</Relationships>"
+)
+_XLSX_WORKBOOK_RELS = (
+    _XML_DECL
+    + f'<Relationships xmlns="{_NS_PKG_REL}">'
+    f'<Relationship Id="rId1" Type="{_NS_REL}/worksheet" Target="worksheets/sheet1.xml"/>'
+    f'<Relationship Id="rId2" Type="{_NS_REL}/styles" Target="styles.xml"/>'
+    "</Relationships>"
+)
+_XLSX_STYLES = (
+    _XML_DECL
+    + f'<styleSheet xmlns="{_NS_MAIN}">'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    "</styleSheet>"
+)
+
+# Control chars that are not allowed anywhere in an XML 1.0 document
+_XML_ILLEGAL_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def _col_letter(idx: int) -> str:
+    letters = ""
+    idx += 1
+    while idx:
+        idx, rem = divmod(idx - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+def _xml_row(r: int, letters: List[str], numeric: List[bool], values) -> str:
+    """One <row>; numbers as <v>, text as inline strings, NaN/inf/"" left blank."""
+    cells = []
+    for col, is_num, v in zip(letters, numeric, values):
+        if is_num:
+            if isfinite(v):
+                cells.append(f'<c r="{col}{r}"><v>{v!r}</v></c>')
+        elif v:
+            t = xml_escape(_XML_ILLEGAL_RE.sub("", str(v)))
+            cells.append(f'<c r="{col}{r}" t="inlineStr"><is><t xml:space="preserve">{t}</t></is></c>')
+    return f'<row r="{r}">{"".join(cells)}</row>'
+
+def build_xlsx(df: pd.DataFrame, sheet_name: str = "Detail") -> BytesIO:
+    """
+    Write the frame as a minimal single-sheet .xlsx, emitting the sheet XML
+    directly (no openpyxl cell objects). Unstyled; NaN cells are left blank.
+    """
+    letters = [_col_letter(i) for i in range(len(df.columns))]
+    numeric = [pd.api.types.is_numeric_dtype(dt) for dt in df.dtypes]
+    workbook = (
+        _XML_DECL
+        + f'<workbook xmlns="{_NS_MAIN}" xmlns:r="{_NS_REL}"><sheets>'
+        f'<sheet name={xml_quoteattr(sheet_name)} sheetId="1" r:id="rId1"/>'
+        "</sheets></workbook>"
+    )
+
+    output = BytesIO()
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", _XLSX_CONTENT_TYPES)
+        zf.writestr("_rels/.rels", _XLSX_ROOT_RELS)
+        zf.writestr("xl/workbook.xml", workbook)
+        zf.writestr("xl/_rels/workbook.xml.rels", _XLSX_WORKBOOK_RELS)
+        zf.writestr("xl/styles.xml", _XLSX_STYLES)
+        with zf.open("xl/worksheets/sheet1.xml", "w") as fh:
+            fh.write(f'{_XML_DECL}<worksheet xmlns="{_NS_MAIN}"><sheetData>'.encode("utf-8"))
+            fh.write(_xml_row(1, letters, [False] * len(letters), df.columns).encode("utf-8"))
+            for r, values in enumerate(df.itertuples(index=False, name=None), start=2):
+                fh.write(_xml_row(r, letters, numeric, values).encode("utf-8"))
+            fh.write(b"</sheetData></worksheet>")
+    output.seek(0)
+    return output
+
+# Whole workbooks, shared by every session: only the last few, for an hour at most
+@st.cache_data(show_spinner=False, max_entries=8, ttl=3600)
+def export_xlsx(inputs_key: str, _df: pd.DataFrame) -> bytes:
+    """
+    build_xlsx bytes, cached on `inputs_key` (a digest of everything `_df` is
+    built from). The frame itself isn't hashed: st.cache_data only samples
+    large frames, so it could return a stale export.
+    """
+    return build_xlsx(_df).getvalue()
 
 # ----------------------------- UI Controls ---------------------------------- #
 
@@ -146,70 +392,81 @@ uploaded_files = st.file_uploader(
 # ------------------------------ Main Flow ----------------------------------- #
 
 if uploaded_files:
-    all_details = []
-    doc_badges = []
-    meta_dates = []
+    all_columns: Dict[str, List[str]] = {c: [] for c in FIXED_COLS}
+    doc_badges = set()
+    meta_dates = set()
+
+    override = None if use_header_date else manual_date_value.strftime("%Y-%m-%d")
+    today = date.today().strftime("%Y-%m-%d")
+
+    # `details` is fully determined by the upload bytes, the override and `today`
+    # (filled in below for reports without a header date); this keys the export cache
+    inputs_hash = hashlib.sha256(f"{override}|{today}".encode())
 
     for f in uploaded_files:
-        raw = f.read()
-        txt = None
-        for enc in ("utf-8-sig", "utf-8", "latin-1"):
-            try:
-                txt = raw.decode(enc)
-                break
-            except UnicodeDecodeError:
-                continue
-        if txt is None:
-            st.error(f"Could not decode **{f.name}** — skipping.")
-            continue
-
-        override = None if use_header_date else manual_date_value.strftime("%Y-%m-%d")
-        detail_df, meta = parse_one_text(txt, override_date=override)
-
-        all_details.append(detail_df)
-        doc_badges.append(meta.get("doc_no") or f.name)
-        meta_dates.append(meta.get("date_rcvd"))
-
-    details = pd.concat(all_details, ignore_index=True) if all_details else pd.DataFrame()
-
-    # Badges
-    st.markdown("<div style='margin:6px 0;'>", unsafe_allow_html=True)
-    for d in sorted(set(doc_badges)):
-        st.markdown(
-            f"""<span style="
-                display:inline-block; margin:4px 6px 0 0; padding:6px 10px;
-                background:#E8F1FF; color:#1640D6; border-radius:999px;
-                font-weight:600; font-size:0.90rem;">{d}</span>""",
-            unsafe_allow_html=True,
-        )
-    st.markdown("</div>", unsafe_allow_html=True)
+        # getvalue(), not read(): no cursor state to reset between reruns, and
+        # the same bytes object is what parse_bytes' cache key is hashed from
+        raw = f.getvalue()
+        inputs_hash.update(len(raw).to_bytes(8, "little"))
+        inputs_hash.update(raw)
+        columns, meta = parse_bytes(raw, override)
+        # No header date: fall back to today per run, outside the parse cache
+        date_rcvd = meta.get("date_rcvd") or today
+        for c in FIXED_COLS:
+            if c == "Date Rcvd":
+                all_columns[c].extend([date_rcvd] * len(columns["Line"]))
+            else:
+                all_columns[c].extend(columns[c])
+        doc_badges.add(meta.get("doc_no") or f.name)
+        meta_dates.add(date_rcvd)
+
+    # Sorted once; reused for badges, caption and filename
+    unique_docs = sorted(doc_badges)
+    unique_dates = sorted(meta_dates)
+
+    details = pd.DataFrame(all_columns, columns=FIXED_COLS)
+    inputs_key = inputs_hash.hexdigest()
+
+    # Coerce numerics (parser keeps everything as str)
+    details[NUMERIC_COLS] = details[NUMERIC_COLS].apply(pd.to_numeric, errors="coerce")
+
+    # Badges (single render)
+    badges_html = "".join(
+        f"""<span style="
+            display:inline-block; margin:4px 6px 0 0; padding:6px 10px;
+            background:#E8F1FF; color:#1640D6; border-radius:999px;
+            font-weight:600; font-size:0.90rem;">{d}</span>"""
+        for d in unique_docs
+    )
+    st.markdown(f"<div style='margin:6px 0;'>{badges_html}</div>", unsafe_allow_html=True)
 
     # Date caption
-    if use_header_date and meta_dates:
-        st.caption(f"Using Date Rcvd from headers. Range in files: **{', '.join(sorted(set(meta_dates)))}**")
+    if use_header_date and unique_dates:
+        st.caption(f"Using Date Rcvd from headers. Range in files: **{', '.join(unique_dates)}**")
     else:
         st.caption(f"Using overridden Date Rcvd: **{manual_date_value.strftime('%Y-%m-%d')}**")
 
     # Table only (Summary removed)
     st.subheader("😎 Here is your data! You can copy direct from here and paste into the Shortages Spreadsheet!")
-    st.dataframe(details, use_container_width=True)
+    with st.expander("Preview data", expanded=True):
+        # Only the first PREVIEW_ROWS rows are shipped to the browser; the download has everything
+        if len(details) > PREVIEW_ROWS:
+            st.caption(f"Showing the first {PREVIEW_ROWS:,} of {len(details):,} rows — download the Excel file for the rest.")
+            st.dataframe(details.head(PREVIEW_ROWS), width="stretch")
+        else:
+            st.dataframe(details, width="stretch")
 
     # ----------------------------- Excel Export ------------------------------ #
-    output = BytesIO()
-    # Use openpyxl to avoid the xlsxwriter dependency
-    details.to_excel(output, sheet_name="Detail", index=False, engine="openpyxl")
-    output.seek(0)
-
     # Filename
-    unique_docs = sorted(set(doc_badges))
     doc_part = unique_docs[0] if len(unique_docs) == 1 else "MULTI"
     date_part = (manual_date_value.strftime("%Y-%m-%d") if not use_header_date
-                 else ("_".join(sorted(set(meta_dates))) if meta_dates else date.today().strftime("%Y-%m-%d")))
+                 else ("_".join(unique_dates) if unique_dates else today))
     filename = f"shortage_report_{doc_part}_{date_part}.xlsx"
 
     st.download_button(
         label="📥 Download Excel File",
-        data=output,
+        # Built only when clicked (and cached per frame); hand-rolled xlsx, no openpyxl
+        data=lambda: export_xlsx(inputs_key, details),
         file_name=filename,
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
     )